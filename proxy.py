@@ -36,13 +36,20 @@ Usage:
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse, JSONResponse
 from starlette.background import BackgroundTask
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+import json
+import math
 import httpx
 import os
+import re
 import logging
 import asyncio
 import random
 from pathlib import Path
+import anyio
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -55,10 +62,22 @@ try:
 except ImportError:
     pass  # dotenv not installed, will use environment variables
 
+# Fast JSON parsing for request bodies (only used to sniff routing fields)
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not installed, use stdlib json
+
+# TTL cache for repeated deterministic requests
+try:
+    from cachetools import TTLCache
+except ImportError:
+    TTLCache = None  # cachetools not installed, response caching disabled
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Manage application lifecycle - create persistent HTTP client"""
-    # Startup: Create persistent client with granular timeout and connection limits
+    """Manage application lifecycle - create one persistent HTTP client per upstream"""
+    # Startup: Create persistent clients with granular timeout and connection limits
     connect_timeout = float(os.getenv("CONNECT_TIMEOUT", "10"))
     read_timeout = float(os.getenv("READ_TIMEOUT", "300"))  # 5 minutes for slow providers
     write_timeout = float(os.getenv("WRITE_TIMEOUT", "30"))
@@ -71,18 +90,33 @@ async def lifespan(app: FastAPI):
         pool=pool_timeout
     )
 
-    # Connection pool limits to prevent exhaustion
+    # Connection pool limits per upstream so a slow provider can't starve the others.
+    # Default must cover every tier semaphore that could share one host, and keep-alive
+    # matches it so idle connections aren't torn down (and re-handshaked) between calls.
+    max_connections = int(os.getenv(
+        "MAX_CONNECTIONS", str(max(100, MAX_CONCURRENT_REQUESTS * max(1, len(PROVIDER_ROUTES))))
+    ))
     limits = httpx.Limits(
-        max_connections=int(os.getenv("MAX_CONNECTIONS", "100")),
-        max_keepalive_connections=int(os.getenv("MAX_KEEPALIVE_CONNECTIONS", "20")),
-        keepalive_expiry=float(os.getenv("KEEPALIVE_EXPIRY", "30.0"))
+        max_connections=max_connections,
+        max_keepalive_connections=int(os.getenv("MAX_KEEPALIVE_CONNECTIONS", str(max_connections))),
+        keepalive_expiry=float(os.getenv("KEEPALIVE_EXPIRY", "60.0"))
     )
 
-    app.state.http_client = httpx.AsyncClient(timeout=timeout_config, limits=limits)
-    logger.info(f"HTTP client initialized - connect: {connect_timeout}s, read: {read_timeout}s")
+    # One client per base URL (real Anthropic + each configured provider).
+    # HTTP/2 lets concurrent requests to the same provider multiplex over one connection.
+    base_urls = [ANTHROPIC_BASE_URL] + [route[1] for route in PROVIDER_ROUTES.values()]
+    app.state.clients = {
+        base_url: httpx.AsyncClient(timeout=timeout_config, limits=limits, http2=True)
+        for base_url in dict.fromkeys(base_urls)  # dedupe providers sharing a host
+    }
+    logger.info(
+        "HTTP clients initialized (HTTP/2, %s upstreams) - connect: %ss, read: %ss",
+        len(app.state.clients), connect_timeout, read_timeout
+    )
     yield
-    # Shutdown: Clean up client
-    await app.state.http_client.aclose()
+    # Shutdown: Clean up clients
+    for client in app.state.clients.values():
+        await client.aclose()
 
 app = FastAPI(
     title="Custom Model Proxy for Claude Code",
@@ -112,28 +146,222 @@ MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 BASE_RETRY_DELAY = float(os.getenv("BASE_RETRY_DELAY", "1.0"))  # Initial delay in seconds
 MAX_RETRY_DELAY = float(os.getenv("MAX_RETRY_DELAY", "60.0"))   # Maximum delay cap
 
+# Backoff ceiling per attempt: base * 2^attempt, capped at MAX_RETRY_DELAY (precomputed once)
+RETRY_DELAY_CEILINGS = tuple(min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * (2 ** attempt)) for attempt in range(MAX_RETRIES))
+
 # Concurrency control - separate semaphore per provider to prevent overwhelming
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "5"))
-haiku_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-opus_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-sonnet_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# CapacityLimiter exposes slot usage publicly and raises on a release without a matching acquire
+haiku_semaphore = anyio.CapacityLimiter(MAX_CONCURRENT_REQUESTS)
+opus_semaphore = anyio.CapacityLimiter(MAX_CONCURRENT_REQUESTS)
+sonnet_semaphore = anyio.CapacityLimiter(MAX_CONCURRENT_REQUESTS)
+
+# Response cache - exact-match cache for non-streaming, tool-free, temperature=0 requests
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))  # 0 disables caching
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", "65536"))  # Skip larger request bodies
+response_cache = (
+    TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+    if TTLCache is not None and RESPONSE_CACHE_SIZE > 0 else None
+)
+
+
+class NullSemaphore:
+    """No-op async context manager used where no concurrency limit applies (OAuth passthrough)"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+NULL_SEMAPHORE = NullSemaphore()
+
+# Media type of Anthropic streaming responses (used for Accept and the streamed reply)
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# Client headers forwarded on OAuth passthrough to real Anthropic
+FORWARD_HEADERS = ("anthropic-version", "anthropic-beta", "x-api-key")
+
+# Upstream response headers never passed back to the client:
+# - hop-by-hop headers (RFC 7230 section 6.1)
+# - Content-Length, which Starlette sets (or replaces with chunked encoding) for the body it sends
+# - Date / Server, which uvicorn adds itself (forwarding them would duplicate them)
+# - Set-Cookie / Alt-Svc, which belong to the upstream host (e.g. Cloudflare), not this proxy
+# Everything else - including anthropic-ratelimit-* and x-should-retry - is forwarded.
+DROPPED_RESPONSE_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade", "content-length",
+    "date", "server", "set-cookie", "alt-svc",
+))
+# Bodies already decoded by httpx no longer carry the upstream Content-Encoding
+DROPPED_DECODED_RESPONSE_HEADERS = DROPPED_RESPONSE_HEADERS | {"content-encoding"}
+
+
+def build_provider_headers(api_key):
+    """Static upstream headers for a provider - built once at startup, copied per request"""
+    headers = {"Content-Type": "application/json"}
+    # Add auth if API key is set
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+
+# Routing table - model name → provider config, built once since tiers are static.
+# setdefault keeps Haiku > Opus > Sonnet precedence when tiers share a model name.
+PROVIDER_ROUTES = {}
+if HAIKU_BASE_URL:
+    PROVIDER_ROUTES.setdefault(HAIKU_MODEL, (
+        HAIKU_API_KEY, HAIKU_BASE_URL, "Haiku Provider", haiku_semaphore, build_provider_headers(HAIKU_API_KEY)
+    ))
+if OPUS_BASE_URL:
+    PROVIDER_ROUTES.setdefault(OPUS_MODEL, (
+        OPUS_API_KEY, OPUS_BASE_URL, "Opus Provider", opus_semaphore, build_provider_headers(OPUS_API_KEY)
+    ))
+if SONNET_BASE_URL:
+    PROVIDER_ROUTES.setdefault(SONNET_MODEL, (
+        SONNET_API_KEY, SONNET_BASE_URL, "Sonnet Provider", sonnet_semaphore, build_provider_headers(SONNET_API_KEY)
+    ))
+
+
+def build_passthrough_headers(request_headers) -> dict:
+    """Upstream headers for OAuth passthrough to real Anthropic, copied from the client request"""
+    headers = {"Content-Type": "application/json"}
+
+    # Forward OAuth token (Starlette headers are case-insensitive, no copy needed)
+    authorization = request_headers.get("authorization")
+    if authorization:
+        headers["Authorization"] = authorization
+
+    # Forward Anthropic headers (anthropic-beta is CRITICAL for OAuth)
+    for header in FORWARD_HEADERS:
+        value = request_headers.get(header)
+        if value is not None:
+            headers[header] = value
+    return headers
+
+
+def parse_request_body(body: bytes) -> dict:
+    """Parse a request body to read routing fields - orjson when available, stdlib otherwise"""
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than stdlib (e.g. lone surrogate escapes from truncated emoji)
+            pass
+    return json.loads(body)
 
 
 def get_provider_config(model_name: str):
     """
     Determine which provider to route to based on model name.
-    Returns (api_key, base_url, provider_name, semaphore) or None for OAuth passthrough.
+    Returns (api_key, base_url, provider_name, semaphore, headers) or None for OAuth passthrough.
     """
-    # Check if model matches configured tier models
-    if model_name == HAIKU_MODEL and HAIKU_BASE_URL:
-        return (HAIKU_API_KEY, HAIKU_BASE_URL, "Haiku Provider", haiku_semaphore)
-    elif model_name == OPUS_MODEL and OPUS_BASE_URL:
-        return (OPUS_API_KEY, OPUS_BASE_URL, "Opus Provider", opus_semaphore)
-    elif model_name == SONNET_MODEL and SONNET_BASE_URL:
-        return (SONNET_API_KEY, SONNET_BASE_URL, "Sonnet Provider", sonnet_semaphore)
+    # Unrouted models default to OAuth passthrough (real Anthropic) - no semaphore needed
+    return PROVIDER_ROUTES.get(model_name)
+
 
-    # Default to OAuth passthrough (real Anthropic) - no semaphore needed
-    return None
+# Rate limit reset headers, most authoritative first. Values may be delta-seconds,
+# an HTTP-date, an RFC 3339 timestamp (Anthropic) or a duration like "1m30s" (GLM/OpenAI-style).
+RATE_LIMIT_RESET_HEADERS = (
+    "retry-after",
+    "anthropic-ratelimit-requests-reset",
+    "x-ratelimit-reset-requests",
+)
+RESET_DURATION_PATTERN = re.compile(r"(?:\d+(?:\.\d+)?(?:ms|s|m|h))+")
+RESET_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+RESET_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_delay(value: str):
+    """Seconds until a rate limit reset header value, or None if it can't be parsed"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if RESET_DURATION_PATTERN.fullmatch(value):
+        return sum(float(amount) * RESET_DURATION_UNITS[unit] for amount, unit in RESET_DURATION_PART.findall(value))
+
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            reset_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if reset_at is None:
+            return None
+
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    return (reset_at - datetime.now(timezone.utc)).total_seconds()
+
+
+def get_rate_limit_delay(headers, attempt: int) -> float:
+    """
+    Delay before retrying a 429, honoring the provider's reset headers.
+    Capped at MAX_RETRY_DELAY so one 429 can't park a request for minutes (or forever);
+    falls back to exponential backoff when no header is present, parseable and finite.
+    """
+    for name in RATE_LIMIT_RESET_HEADERS:
+        value = headers.get(name)
+        if value:
+            delay = parse_reset_delay(value)
+            if delay is not None and math.isfinite(delay):
+                return min(MAX_RETRY_DELAY, max(0.0, delay))
+    return calculate_retry_delay(attempt)
+
+
+def get_cache_key(body: bytes, data: dict, target_headers: dict):
+    """
+    Cache key for a request, or None if its response must not be cached.
+    Only deterministic requests qualify: non-streaming, no tools, temperature=0.
+    Upstream headers are hashed too so different credentials/betas never share entries.
+    """
+    if (
+        response_cache is None
+        or len(body) > RESPONSE_CACHE_MAX_BODY
+        or data.get("stream")
+        or data.get("tools")
+        or data.get("temperature") != 0
+    ):
+        return None
+
+    digest = hashlib.blake2b(body, digest_size=16)
+    for name, value in sorted(target_headers.items()):
+        digest.update(f"\n{name}:{value}".encode())
+    return digest.digest()
+
+
+def filter_response_headers(response: httpx.Response, decoded: bool = False) -> dict:
+    """
+    Upstream response headers to return to the client, minus DROPPED_RESPONSE_HEADERS.
+    Content-Encoding is kept for raw (aiter_raw) bodies, which are forwarded still encoded;
+    pass decoded=True when httpx has already decoded the body so the header no longer applies.
+    """
+    headers = response.headers
+    drop = DROPPED_DECODED_RESPONSE_HEADERS if decoded else DROPPED_RESPONSE_HEADERS
+    # Connection may name further per-hop headers - only then is a per-response set needed
+    connection = headers.get("connection")
+    if connection:
+        drop = drop | {token.strip().lower() for token in connection.split(",")}
+    return {name: value for name, value in headers.items() if name not in drop}
+
+
+# Upstream errors with a specific client-facing response: type → (status, message, log label).
+# Anything not listed is reported as a 500 internal proxy error.
+PROXY_ERRORS = {
+    httpx.ReadTimeout: (504, "Gateway timeout - provider did not respond in time", "Read Timeout"),
+    httpx.ConnectTimeout: (504, "Gateway timeout - could not connect to provider", "Connect Timeout"),
+}
+
+
+def classify_proxy_error(e: Exception):
+    """Map a failed upstream attempt to (status_code, error_message, log_label)"""
+    return PROXY_ERRORS.get(type(e)) or (500, f"Internal proxy error: {e}", "Unexpected Error")
 
 
 def calculate_retry_delay(attempt: int) -> float:
@@ -141,10 +369,8 @@ def calculate_retry_delay(attempt: int) -> float:
     Calculate retry delay with exponential backoff and full jitter.
     Full jitter prevents thundering herd problem.
     """
-    # Exponential backoff: base * 2^attempt, capped at MAX_RETRY_DELAY
-    max_delay = min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * (2 ** attempt))
-    # Full jitter: random between 0 and max_delay
-    return random.uniform(0, max_delay)
+    # Full jitter: random between 0 and the attempt's exponential backoff ceiling
+    return random.random() * RETRY_DELAY_CEILINGS[attempt]
 
 
 async def safe_stream_wrapper(stream, model_name: str):
@@ -153,191 +379,196 @@ async def safe_stream_wrapper(stream, model_name: str):
         async for chunk in stream:
             yield chunk
     except httpx.ReadTimeout:
-        logger.error(f"[Mid-Stream Timeout] {model_name} - provider stopped sending data")
+        logger.error("[Mid-Stream Timeout] %s - provider stopped sending data", model_name)
         # Stream is broken, stop yielding
     except httpx.NetworkError as e:
-        logger.error(f"[Mid-Stream Network Error] {model_name} - {e}")
+        logger.error("[Mid-Stream Network Error] %s - %s", model_name, e)
         # Stream is broken, stop yielding
     except Exception as e:
-        logger.error(f"[Mid-Stream Error] {model_name} - {type(e).__name__}: {e}")
+        logger.error("[Mid-Stream Error] %s - %s: %s", model_name, type(e).__name__, e)
         # Stream is broken, stop yielding
 
 
+class HeldSlotStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that runs `cleanup` (close upstream, release provider slot) once the
+    body has been sent. Unlike a BackgroundTask, this also runs if the client disconnects.
+    """
+
+    def __init__(self, content, cleanup: AsyncExitStack, **kwargs):
+        super().__init__(content, **kwargs)
+        self.cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.cleanup.aclose()
+
+
 @app.post("/v1/messages")
 async def proxy_messages(request: Request):
     """
     Route requests based on model name with:
-    - Concurrency limiting via semaphores
+    - Concurrency limiting via semaphores (non-streaming: held until the body is sent;
+      streaming: held until response headers arrive)
     - Retry with exponential backoff + jitter
     - Rate limit handling
     - Comprehensive error handling
+
+    Non-streaming bodies are piped through, so a timeout after the status line has been
+    sent can't be retried - the client gets a truncated body instead.
     """
-    data = await request.json()
+    # Keep the raw body to forward as-is - parse only to read routing fields
+    body = await request.body()
+    data = parse_request_body(body)
     original_model = data.get("model", "")
     is_streaming = data.get("stream", False)
-    original_headers = dict(request.headers)
 
     # Check which provider to route to
     provider_config = get_provider_config(original_model)
 
     if provider_config:
         # Route to custom provider
-        api_key, base_url, provider_name, provider_semaphore = provider_config
+        api_key, base_url, provider_name, provider_semaphore, provider_headers = provider_config
         target_url = f"{base_url}/v1/messages"
-        target_headers = {"Content-Type": "application/json"}
+        target_headers = provider_headers.copy()  # Template is shared, never mutate it
 
-        # Add auth if API key is set
-        if api_key:
-            target_headers["Authorization"] = f"Bearer {api_key}"
-
-        logger.info(f"[Proxy] {original_model} → {provider_name}")
+        logger.info("[Proxy] %s → %s", original_model, provider_name)
     else:
         # Default to Real Anthropic with OAuth passthrough (no semaphore)
         provider_semaphore = None
-        target_url = f"{ANTHROPIC_BASE_URL}/v1/messages"
-        target_headers = {"Content-Type": "application/json"}
-
-        # Forward OAuth token
-        if "authorization" in original_headers:
-            target_headers["Authorization"] = original_headers["authorization"]
-
-        # Forward Anthropic headers (anthropic-beta is CRITICAL for OAuth)
-        for header in ["anthropic-version", "anthropic-beta", "x-api-key"]:
-            if header in original_headers:
-                target_headers[header] = original_headers[header]
+        base_url = ANTHROPIC_BASE_URL
+        target_url = f"{base_url}/v1/messages"
+        target_headers = build_passthrough_headers(request.headers)
 
         # Debug logging for auth method
-        auth_method = "OAuth" if "authorization" in original_headers else "API Key"
-        has_beta = "anthropic-beta" in original_headers
-        logger.info(f"[Proxy] {original_model} → Real Anthropic ({auth_method}, beta={has_beta})")
-
-    # Get persistent client from app state
-    client = request.app.state.http_client
+        auth_method = "OAuth" if "Authorization" in target_headers else "API Key"
+        has_beta = "anthropic-beta" in target_headers
+        logger.info("[Proxy] %s → Real Anthropic (%s, beta=%s)", original_model, auth_method, has_beta)
+
+    # Serve repeated deterministic requests from the response cache
+    cache_key = get_cache_key(body, data, target_headers)
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            status_code, content, content_type = cached
+            logger.info("[Cache Hit] %s", original_model)
+            return Response(content=content, status_code=status_code, media_type=content_type)
+
+    # Get persistent client for this upstream from app state
+    client = request.app.state.clients[base_url]
 
     # Semaphore context manager (only for custom providers)
-    semaphore_ctx = provider_semaphore if provider_semaphore else asyncio.Semaphore(9999)
+    semaphore_ctx = provider_semaphore or NULL_SEMAPHORE
 
     # Retry loop with exponential backoff + jitter
-    async with semaphore_ctx:
-        # Log semaphore acquisition
-        if provider_semaphore:
-            slots_available = provider_semaphore._value
-            logger.info(f"[Concurrency] Acquired slot (available: {slots_available}/{MAX_CONCURRENT_REQUESTS})")
+    retry_delay = 0.0
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            # Back off with the provider slot released so other requests can use it
+            await asyncio.sleep(retry_delay)
+
+        # Hold a slot only while a request is in flight - exiting the block
+        # (return or continue) releases it, unless a response takes it over via pop_all()
+        async with AsyncExitStack() as attempt_stack:
+            await attempt_stack.enter_async_context(semaphore_ctx)
+
+            # Log semaphore acquisition (debug only - runs once per attempt)
+            if provider_semaphore and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "[Concurrency] %s acquired slot (available: %s/%s)",
+                    provider_name, provider_semaphore.available_tokens, provider_semaphore.total_tokens
+                )
 
-        for attempt in range(MAX_RETRIES):
             try:
                 # Forward request
+                # Ask for uncompressed bodies so raw bytes can be forwarded without decoding
+                target_headers["Accept-Encoding"] = "identity"
+
                 if is_streaming:
-                    target_headers["Accept"] = "text/event-stream"
+                    target_headers["Accept"] = SSE_MEDIA_TYPE
 
                     # Build request for streaming
                     req = client.build_request(
-                        "POST", target_url, json=data, headers=target_headers
+                        "POST", target_url, content=body, headers=target_headers
                     )
 
-                    # Attempt streaming connection with timeout protection
-                    try:
-                        response = await client.send(req, stream=True)
-                    except (httpx.ReadTimeout, httpx.ConnectTimeout) as e:
-                        error_type = "Read timeout" if isinstance(e, httpx.ReadTimeout) else "Connect timeout"
-                        logger.error(f"[Streaming {error_type}] {original_model} (attempt {attempt + 1}/{MAX_RETRIES})")
-
-                        if attempt < MAX_RETRIES - 1:
-                            retry_delay = calculate_retry_delay(attempt)
-                            logger.warning(f"[Streaming Retry] Retrying in {retry_delay:.2f}s...")
-                            await asyncio.sleep(retry_delay)
-                            continue  # Retry the loop
-                        else:
-                            # Max retries exhausted
-                            return JSONResponse(
-                                status_code=504,
-                                content={"error": f"Gateway timeout - {error_type.lower()} during streaming connection"}
-                            )
-
-                    # Connection successful - return streaming response with safe wrapper
+                    # Attempt streaming connection (timeouts are retried below)
+                    response = await client.send(req, stream=True)
+
+                    # Connection successful - pass raw bytes through as they arrive.
+                    # No chunk_size: httpx would hold tokens back until the chunk filled up.
+                    # Upstream status is kept so error replies (429, 529, ...) aren't sent as 200.
                     return StreamingResponse(
-                        safe_stream_wrapper(response.aiter_bytes(), original_model),
-                        media_type="text/event-stream",
-                        background=BackgroundTask(response.aclose)  # Critical: cleanup
+                        safe_stream_wrapper(response.aiter_raw(), original_model),
+                        status_code=response.status_code,
+                        media_type=SSE_MEDIA_TYPE,
+                        headers=filter_response_headers(response),
+                        # Critical: cleanup. aclose is idempotent, so this is safe even
+                        # when aiter_raw already closed the response at end of stream.
+                        background=BackgroundTask(response.aclose)
                     )
                 else:
-                    # Non-streaming request
-                    response = await client.post(
-                        target_url, json=data, headers=target_headers
+                    # Non-streaming request - piped through rather than buffered in memory
+                    req = client.build_request(
+                        "POST", target_url, content=body, headers=target_headers
                     )
+                    response = await client.send(req, stream=True)
 
                     # Handle rate limiting (429)
                     if response.status_code == 429 and attempt < MAX_RETRIES - 1:
-                        retry_after = response.headers.get("retry-after")
-                        if retry_after:
-                            retry_delay = float(retry_after)
-                        else:
-                            retry_delay = calculate_retry_delay(attempt)
-
-                        logger.warning(f"[429 Rate Limited] Retrying in {retry_delay:.2f}s (attempt {attempt + 1}/{MAX_RETRIES})")
-                        await asyncio.sleep(retry_delay)
+                        retry_delay = get_rate_limit_delay(response.headers, attempt)
+
+                        logger.warning("[429 Rate Limited] Retrying in %.2fs (attempt %s/%s)", retry_delay, attempt + 1, MAX_RETRIES)
+                        await response.aclose()  # Release the connection before retrying
                         continue
 
                     # Log 422 errors for debugging
                     if response.status_code == 422:
-                        logger.error(f"[422 Unprocessable Entity] Model: {original_model}")
-
-                    return Response(
-                        content=response.content,
+                        logger.error("[422 Unprocessable Entity] Model: %s", original_model)
+
+                    # Cacheable requests are small - read them fully so the result can be stored
+                    if cache_key is not None and response.status_code == 200:
+                        try:
+                            content = await response.aread()
+                        finally:
+                            await response.aclose()
+                        content_type = response.headers.get("content-type", "application/json")
+                        response_cache[cache_key] = (response.status_code, content, content_type)
+                        return Response(
+                            content=content,
+                            status_code=response.status_code,
+                            headers=filter_response_headers(response, decoded=True)
+                        )
+
+                    # Keep the slot until the body has been piped through, then release it
+                    # along with the upstream connection (callbacks run last-in, first-out)
+                    attempt_stack.push_async_callback(response.aclose)
+                    return HeldSlotStreamingResponse(
+                        safe_stream_wrapper(response.aiter_raw(), original_model),
+                        cleanup=attempt_stack.pop_all(),
                         status_code=response.status_code,
-                        headers=dict(response.headers)
+                        headers=filter_response_headers(response)
                     )
 
-            except httpx.ReadTimeout:
-                logger.error(f"[Non-streaming Read Timeout] {original_model} (attempt {attempt + 1}/{MAX_RETRIES})")
-                if attempt < MAX_RETRIES - 1:
-                    retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
-                    await asyncio.sleep(retry_delay)
-                    continue
-                # Return 504 Gateway Timeout
-                return JSONResponse(
-                    status_code=504,
-                    content={"error": "Gateway timeout - provider did not respond in time"}
-                )
-
-            except httpx.ConnectTimeout:
-                logger.error(f"[Connect Timeout] {original_model} (attempt {attempt + 1}/{MAX_RETRIES})")
-                if attempt < MAX_RETRIES - 1:
-                    retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
-                    await asyncio.sleep(retry_delay)
-                    continue
-                return JSONResponse(
-                    status_code=504,
-                    content={"error": "Gateway timeout - could not connect to provider"}
-                )
-
-            except httpx.HTTPStatusError as e:
-                logger.error(f"[HTTP Error] {e.response.status_code} - {e.response.text}")
-                return Response(
-                    content=e.response.content,
-                    status_code=e.response.status_code,
-                    headers=dict(e.response.headers)
-                )
-
             except Exception as e:
-                logger.error(f"[Unexpected Error] {original_model} (attempt {attempt + 1}/{MAX_RETRIES}): {type(e).__name__} - {e}")
+                status_code, error_message, error_label = classify_proxy_error(e)
+                logger.error(
+                    "[%s] %s (attempt %s/%s, stream=%s): %s - %s",
+                    error_label, original_model, attempt + 1, MAX_RETRIES, is_streaming, type(e).__name__, e
+                )
                 if attempt < MAX_RETRIES - 1:
                     retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
-                    await asyncio.sleep(retry_delay)
+                    logger.warning("[Retry] Retrying in %.2fs...", retry_delay)
                     continue
-                return JSONResponse(
-                    status_code=500,
-                    content={"error": f"Internal proxy error: {str(e)}"}
-                )
+                return JSONResponse(status_code=status_code, content={"error": error_message})
 
-        # Should not reach here, but just in case
-        return JSONResponse(
-            status_code=500,
-            content={"error": "Max retries exceeded"}
-        )
+    # Should not reach here, but just in case
+    return JSONResponse(
+        status_code=500,
+        content={"error": "Max retries exceeded"}
+    )
 
 
 @app.post("/v1/messages/count_tokens")
@@ -349,18 +580,18 @@ async def proxy_count_tokens(request: Request):
     Third-party providers (like GLM) typically don't support token counting.
     Returns 501 Not Implemented for unsupported providers with helpful guidance.
     """
-    data = await request.json()
+    body = await request.body()
+    data = parse_request_body(body)
     original_model = data.get("model", "")
-    original_headers = dict(request.headers)
 
     # Check which provider would handle this model
     provider_config = get_provider_config(original_model)
 
     if provider_config:
         # Custom provider (GLM, etc.) - most don't support count_tokens
-        api_key, base_url, provider_name, provider_semaphore = provider_config
+        api_key, base_url, provider_name, provider_semaphore, provider_headers = provider_config
 
-        logger.warning(f"[count_tokens] {original_model} → {provider_name} (unsupported endpoint)")
+        logger.warning("[count_tokens] %s → %s (unsupported endpoint)", original_model, provider_name)
 
         # Return helpful error for unsupported providers
         return JSONResponse(
@@ -376,82 +607,46 @@ async def proxy_count_tokens(request: Request):
     else:
         # Real Anthropic with OAuth passthrough - supports count_tokens
         target_url = f"{ANTHROPIC_BASE_URL}/v1/messages/count_tokens"
-        target_headers = {"Content-Type": "application/json"}
-
-        # Forward OAuth token
-        if "authorization" in original_headers:
-            target_headers["Authorization"] = original_headers["authorization"]
-
-        # Forward Anthropic headers (anthropic-beta is CRITICAL for OAuth)
-        for header in ["anthropic-version", "anthropic-beta", "x-api-key"]:
-            if header in original_headers:
-                target_headers[header] = original_headers[header]
+        target_headers = build_passthrough_headers(request.headers)
 
-        logger.info(f"[count_tokens] {original_model} → Real Anthropic")
+        logger.info("[count_tokens] %s → Real Anthropic", original_model)
 
-        # Get persistent client from app state
-        client = request.app.state.http_client
+        # Get persistent client for real Anthropic from app state
+        client = request.app.state.clients[ANTHROPIC_BASE_URL]
 
         # Forward request with retry logic
         for attempt in range(MAX_RETRIES):
             try:
                 response = await client.post(
-                    target_url, json=data, headers=target_headers
+                    target_url, content=body, headers=target_headers
                 )
 
                 # Handle rate limiting (429)
                 if response.status_code == 429 and attempt < MAX_RETRIES - 1:
-                    retry_after = response.headers.get("retry-after")
-                    if retry_after:
-                        retry_delay = float(retry_after)
-                    else:
-                        retry_delay = calculate_retry_delay(attempt)
+                    retry_delay = get_rate_limit_delay(response.headers, attempt)
 
-                    logger.warning(f"[count_tokens 429 Rate Limited] Retrying in {retry_delay:.2f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+                    logger.warning("[count_tokens 429 Rate Limited] Retrying in %.2fs (attempt %s/%s)", retry_delay, attempt + 1, MAX_RETRIES)
                     await asyncio.sleep(retry_delay)
                     continue
 
                 return Response(
                     content=response.content,
                     status_code=response.status_code,
-                    headers=dict(response.headers)
-                )
-
-            except httpx.ReadTimeout:
-                logger.error(f"[count_tokens Read Timeout] {original_model} (attempt {attempt + 1}/{MAX_RETRIES})")
-                if attempt < MAX_RETRIES - 1:
-                    retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
-                    await asyncio.sleep(retry_delay)
-                    continue
-                return JSONResponse(
-                    status_code=504,
-                    content={"error": "Gateway timeout - provider did not respond in time"}
-                )
-
-            except httpx.ConnectTimeout:
-                logger.error(f"[count_tokens Connect Timeout] {original_model} (attempt {attempt + 1}/{MAX_RETRIES})")
-                if attempt < MAX_RETRIES - 1:
-                    retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
-                    await asyncio.sleep(retry_delay)
-                    continue
-                return JSONResponse(
-                    status_code=504,
-                    content={"error": "Gateway timeout - could not connect to provider"}
+                    headers=filter_response_headers(response, decoded=True)
                 )
 
             except Exception as e:
-                logger.error(f"[count_tokens Error] {original_model} (attempt {attempt + 1}/{MAX_RETRIES}): {type(e).__name__} - {e}")
+                status_code, error_message, error_label = classify_proxy_error(e)
+                logger.error(
+                    "[count_tokens %s] %s (attempt %s/%s): %s - %s",
+                    error_label, original_model, attempt + 1, MAX_RETRIES, type(e).__name__, e
+                )
                 if attempt < MAX_RETRIES - 1:
                     retry_delay = calculate_retry_delay(attempt)
-                    logger.warning(f"[Retry] Retrying in {retry_delay:.2f}s...")
+                    logger.warning("[Retry] Retrying in %.2fs...", retry_delay)
                     await asyncio.sleep(retry_delay)
                     continue
-                return JSONResponse(
-                    status_code=500,
-                    content={"error": f"Internal proxy error: {str(e)}"}
-                )
+                return JSONResponse(status_code=status_code, content={"error": error_message})
 
         # Should not reach here
         return JSONResponse(
@@ -485,39 +680,58 @@ async def health_check():
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
 
-    print("=" * 80)
-    print("  Custom Model Proxy for Claude Code - Multi-Provider Edition")
-    print("=" * 80)
-    print()
-    print(f"Port: {PORT}")
-    print()
-    print("Model Tier Configuration:")
-    print(f"  Haiku  → {HAIKU_MODEL}")
-    print(f"           Provider: {HAIKU_BASE_URL or 'Real Anthropic (OAuth)'}")
-    print(f"           API Key: {'✓ Set' if HAIKU_API_KEY else '✗ Not Set'}")
-    print()
-    print(f"  Opus   → {OPUS_MODEL}")
-    print(f"           Provider: {OPUS_BASE_URL or 'Real Anthropic (OAuth)'}")
-    print(f"           API Key: {'✓ Set' if OPUS_API_KEY else '✗ Not Set'}")
-    print()
-    print(f"  Sonnet → {SONNET_MODEL}")
-    print(f"           Provider: {SONNET_BASE_URL or 'Real Anthropic (OAuth)'}")
-    print(f"           API Key: {'✓ Set' if SONNET_API_KEY else '✗ Not Set'}")
-    print()
-    print("Routing Logic:")
-    print(f"  • {HAIKU_MODEL} → {'Custom Haiku Provider' if HAIKU_BASE_URL else 'Real Anthropic'}")
-    print(f"  • {OPUS_MODEL} → {'Custom Opus Provider' if OPUS_BASE_URL else 'Real Anthropic'}")
-    print(f"  • {SONNET_MODEL} → {'Custom Sonnet Provider' if SONNET_BASE_URL else 'Real Anthropic'}")
-    print()
-    print("Configure Claude Code:")
-    print("  export ANTHROPIC_DEFAULT_HAIKU_MODEL=glm-4.6")
-    print("  export ANTHROPIC_DEFAULT_OPUS_MODEL=glm-4.5-air")
-    print("  # export ANTHROPIC_DEFAULT_SONNET_MODEL=glm-4-plus  # Optional")
-    print(f"  export ANTHROPIC_BASE_URL=http://localhost:{PORT}")
-    print()
-    print(f"Starting proxy on http://localhost:{PORT}")
-    print("=" * 80)
-
-    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
+    # Build the whole banner up front and emit it with a single write
+    rule = "=" * 80
+    banner = f"""{rule}
+  Custom Model Proxy for Claude Code - Multi-Provider Edition
+{rule}
+
+Port: {PORT}
+
+Model Tier Configuration:
+  Haiku  → {HAIKU_MODEL}
+           Provider: {HAIKU_BASE_URL or 'Real Anthropic (OAuth)'}
+           API Key: {'✓ Set' if HAIKU_API_KEY else '✗ Not Set'}
+
+  Opus   → {OPUS_MODEL}
+           Provider: {OPUS_BASE_URL or 'Real Anthropic (OAuth)'}
+           API Key: {'✓ Set' if OPUS_API_KEY else '✗ Not Set'}
+
+  Sonnet → {SONNET_MODEL}
+           Provider: {SONNET_BASE_URL or 'Real Anthropic (OAuth)'}
+           API Key: {'✓ Set' if SONNET_API_KEY else '✗ Not Set'}
+
+Routing Logic:
+  • {HAIKU_MODEL} → {'Custom Haiku Provider' if HAIKU_BASE_URL else 'Real Anthropic'}
+  • {OPUS_MODEL} → {'Custom Opus Provider' if OPUS_BASE_URL else 'Real Anthropic'}
+  • {SONNET_MODEL} → {'Custom Sonnet Provider' if SONNET_BASE_URL else 'Real Anthropic'}
+
+Configure Claude Code:
+  export ANTHROPIC_DEFAULT_HAIKU_MODEL=glm-4.6
+  export ANTHROPIC_DEFAULT_OPUS_MODEL=glm-4.5-air
+  # export ANTHROPIC_DEFAULT_SONNET_MODEL=glm-4-plus  # Optional
+  export ANTHROPIC_BASE_URL=http://localhost:{PORT}
+
+Starting proxy on http://localhost:{PORT}
+{rule}
+"""
+    sys.stdout.write(banner)
+    sys.stdout.flush()
+
+    # Prefer the fast event loop / HTTP parser; uvloop isn't available on Windows
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+
+    # Access log disabled - routing is already logged per request by the proxy itself
+    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info", loop=loop, http=http, access_log=False)